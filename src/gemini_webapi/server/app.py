@@ -3,11 +3,13 @@ from __future__ import annotations
 import asyncio
 import secrets
 import time
+from collections.abc import AsyncIterator, Callable
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
 
-from fastapi import Depends, FastAPI, HTTPException, Request, status
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from httpx import AsyncClient, HTTPError, HTTPStatusError
+from httpx import AsyncClient, HTTPError, HTTPStatusError, Limits
 from loguru import logger
 
 from ..client import GeminiClient
@@ -42,6 +44,14 @@ from .service import (
 
 WEBHOOK_RETRY_ATTEMPTS = 3
 WEBHOOK_RETRY_DELAY_SECONDS = 2
+WEBHOOK_TIMEOUT_SECONDS = 30.0
+WEBHOOK_BATCH_MAX_SIZE = 50
+WEBHOOK_MAX_CONCURRENT_DELIVERIES = 64
+WEBHOOK_DRAIN_TIMEOUT_SECONDS = 10.0
+TASK_DRAIN_TIMEOUT_SECONDS = 30.0
+TASK_SWEEP_INTERVAL_SECONDS = 60
+DEFAULT_MAX_INFLIGHT_TASKS = 16
+DEFAULT_WEBHOOK_WORKERS = 4
 
 
 def _format_http_error(exc: HTTPError) -> str:
@@ -60,31 +70,41 @@ def _format_http_error(exc: HTTPError) -> str:
     return f"{type(exc).__name__}: {exc} | request_url={getattr(exc, 'request', {}).url if hasattr(getattr(exc, 'request', None), 'url') else 'unknown'}"
 
 
+def _create_webhook_client() -> AsyncClient:
+    """Create the pooled HTTP client shared by all webhook deliveries."""
+    return AsyncClient(
+        timeout=WEBHOOK_TIMEOUT_SECONDS,
+        http2=True,
+        limits=Limits(max_keepalive_connections=50, max_connections=200),
+    )
+
+
 async def call_webhook(
+    client: AsyncClient,
     webhook_url: str,
     payload: dict,
     max_retries: int = WEBHOOK_RETRY_ATTEMPTS,
 ) -> bool:
     """Call a webhook URL with the given payload.
     
+    The shared ``client`` keeps connections alive between deliveries and retries.
     Retries up to max_retries times with exponential backoff.
     Returns True if successful, False otherwise.
     """
     for attempt in range(max_retries):
         try:
-            async with AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    webhook_url,
-                    json=payload,
-                    headers={"Content-Type": "application/json"},
-                )
-                if response.status_code < 400:
-                    logger.info(f"Webhook called successfully: {webhook_url}")
-                    return True
-                logger.warning(
-                    f"Webhook returned status {response.status_code}, "
-                    f"attempt {attempt + 1}/{max_retries}"
-                )
+            response = await client.post(
+                webhook_url,
+                json=payload,
+                headers={"Content-Type": "application/json"},
+            )
+            if response.status_code < 400:
+                logger.info(f"Webhook called successfully: {webhook_url}")
+                return True
+            logger.warning(
+                f"Webhook returned status {response.status_code}, "
+                f"attempt {attempt + 1}/{max_retries}"
+            )
         except Exception as e:
             logger.warning(
                 f"Webhook call failed: {e}, attempt {attempt + 1}/{max_retries}"
@@ -97,67 +117,166 @@ async def call_webhook(
     return False
 
 
+async def _deliver_webhook(
+    queue: asyncio.Queue[tuple[str, dict]],
+    client: AsyncClient,
+    webhook_url: str,
+    payload: dict,
+    count: int,
+    limit: asyncio.Semaphore,
+) -> None:
+    """Post one delivery, then release its slot and mark its ``count`` queue items done."""
+    try:
+        await call_webhook(client, webhook_url, payload)
+    except Exception:
+        logger.exception(f"Unexpected error while delivering webhook to {webhook_url}")
+    finally:
+        limit.release()
+        for _ in range(count):
+            queue.task_done()
+
+
+async def _webhook_worker(
+    queue: asyncio.Queue[tuple[str, dict]],
+    client: AsyncClient,
+    batch_window: float,
+    limit: asyncio.Semaphore,
+) -> None:
+    """Deliver queued webhook payloads.
+
+    With a positive ``batch_window`` the worker keeps collecting payloads for that
+    many seconds after the first one arrives, then posts them grouped per URL as
+    ``{"events": [...]}``. Otherwise every payload is posted on its own.
+
+    Each delivery (retries included) runs as its own task, bounded by ``limit``, so
+    a slow or unreachable endpoint never holds up the rest of the queue.
+    """
+    loop = asyncio.get_running_loop()
+    pending: set[asyncio.Task[None]] = set()
+    try:
+        while True:
+            batch = [await queue.get()]
+            if batch_window > 0:
+                deadline = loop.time() + batch_window
+                while len(batch) < WEBHOOK_BATCH_MAX_SIZE:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+
+            if batch_window > 0:
+                grouped: dict[str, list[dict]] = {}
+                for webhook_url, payload in batch:
+                    grouped.setdefault(webhook_url, []).append(payload)
+                deliveries = [(url, {"events": payloads}, len(payloads)) for url, payloads in grouped.items()]
+            else:
+                deliveries = [(url, payload, 1) for url, payload in batch]
+
+            for webhook_url, payload, count in deliveries:
+                await limit.acquire()
+                task = asyncio.create_task(_deliver_webhook(queue, client, webhook_url, payload, count, limit))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _record_failure(task_store: TaskStore, task_id: str, error_message: str) -> None:
+    """Mark a task failed; a task that has vanished from the store must not stop its webhook."""
+    try:
+        await task_store.update_status(task_id, "failed", error=error_message)
+    except TaskNotFoundError:
+        logger.warning(f"Task {task_id} is missing from the task store; sending its webhook anyway")
+
+
 async def process_task_and_notify(
     task_id: str,
     task_store: TaskStore,
     service: ImageEditingService,
     request_data: dict,
     webhook_url: str,
+    webhook_queue: asyncio.Queue[tuple[str, dict]],
+    semaphore: asyncio.Semaphore,
 ) -> None:
-    """Process a session task in the background and notify via webhook."""
-    try:
-        await task_store.update_status(task_id, "processing")
+    """Process a session task in the background and notify via webhook.
+
+    ``semaphore`` bounds how many tasks talk to Gemini at the same time. The
+    webhook payload is handed to ``webhook_queue`` for the delivery workers.
+    """
+    # Waiting tasks stay "pending" until a slot frees up.
+    async with semaphore:
+        try:
+            await task_store.update_status(task_id, "processing")
         
-        result = await service.start_session(
-            request_data["prompt"],
-            image_urls=request_data["image_urls"],
-            model=request_data.get("model"),
-            gem=request_data.get("gem"),
-        )
+            result = await service.start_session(
+                request_data["prompt"],
+                image_urls=request_data["image_urls"],
+                model=request_data.get("model"),
+                gem=request_data.get("gem"),
+                include_image_data=request_data.get("include_image_data", False),
+            )
         
-        await task_store.update_status(task_id, "completed", result=result)
+            await task_store.update_status(task_id, "completed", result=result)
         
-        # Debug logging
-        logger.debug(f"Task {task_id} result type: {type(result)}")
-        logger.debug(f"Task {task_id} result images count: {len(result.images)}")
-        logger.debug(f"Task {task_id} result text: {result.text[:100] if result.text else 'empty'}")
+            # Debug logging
+            logger.debug(f"Task {task_id} result type: {type(result)}")
+            logger.debug(f"Task {task_id} result images count: {len(result.images)}")
+            logger.debug(f"Task {task_id} result text: {result.text[:100] if result.text else 'empty'}")
         
-        result_dict = result.model_dump()
-        logger.debug(f"Task {task_id} serialized images count: {len(result_dict.get('images', []))}")
+            result_dict = result.model_dump()
+            logger.debug(f"Task {task_id} serialized images count: {len(result_dict.get('images', []))}")
         
-        webhook_payload = {
-            "task_id": task_id,
-            "status": "completed",
-            "result": result_dict,
-        }
-        await call_webhook(webhook_url, webhook_payload)
+            webhook_payload = {
+                "task_id": task_id,
+                "status": "completed",
+                "result": result_dict,
+            }
+            await webhook_queue.put((webhook_url, webhook_payload))
         
-    except (InvalidModelError, HTTPError, APIError, GeminiError, ImageGenerationError, 
-            TimeoutError, UsageLimitExceeded, TemporarilyBlocked, ModelInvalid) as exc:
-        error_message = str(exc)
-        logger.error(f"Task {task_id} failed: {error_message}")
+        except (InvalidModelError, HTTPError, APIError, GeminiError, ImageGenerationError, 
+                TimeoutError, UsageLimitExceeded, TemporarilyBlocked, ModelInvalid) as exc:
+            error_message = str(exc)
+            logger.error(f"Task {task_id} failed: {error_message}")
         
-        await task_store.update_status(task_id, "failed", error=error_message)
+            await _record_failure(task_store, task_id, error_message)
         
-        webhook_payload = {
-            "task_id": task_id,
-            "status": "failed",
-            "error": error_message,
-        }
-        await call_webhook(webhook_url, webhook_payload)
+            webhook_payload = {
+                "task_id": task_id,
+                "status": "failed",
+                "error": error_message,
+            }
+            await webhook_queue.put((webhook_url, webhook_payload))
         
-    except Exception as exc:
-        error_message = f"Unexpected error: {exc}"
-        logger.exception(f"Task {task_id} failed with unexpected error")
+        except Exception as exc:
+            error_message = f"Unexpected error: {exc}"
+            logger.exception(f"Task {task_id} failed with unexpected error")
         
-        await task_store.update_status(task_id, "failed", error=error_message)
+            await _record_failure(task_store, task_id, error_message)
         
-        webhook_payload = {
-            "task_id": task_id,
-            "status": "failed",
-            "error": error_message,
-        }
-        await call_webhook(webhook_url, webhook_payload)
+            webhook_payload = {
+                "task_id": task_id,
+                "status": "failed",
+                "error": error_message,
+            }
+            await webhook_queue.put((webhook_url, webhook_payload))
+
+
+async def _sweep_expired_tasks(app: FastAPI) -> None:
+    """Periodically drop finished tasks that have outlived the task TTL."""
+    while True:
+        await asyncio.sleep(TASK_SWEEP_INTERVAL_SECONDS)
+        try:
+            removed = await app.state.task_store.sweep()
+        except Exception:
+            logger.exception("Failed to sweep expired tasks")
+            continue
+        if removed:
+            logger.debug(f"Swept {removed} expired task(s)")
 
 
 def _log_response(endpoint: str, response: ConversationResponse, elapsed: float) -> None:
@@ -194,19 +313,147 @@ def _log_response(endpoint: str, response: ConversationResponse, elapsed: float)
     )
 
 
-def create_app(service: ImageEditingService | None = None) -> FastAPI:
-    app = FastAPI(title="Gemini Image Editing API", version="1.0.0")
+async def get_service(request: Request) -> ImageEditingService:
+    """Resolve the service for a route; override via ``app.dependency_overrides``."""
+    svc = request.app.state.service
+    if svc is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Service not ready")
+    return svc
+
+
+async def _drain_background_tasks(tasks: set[asyncio.Task[None]]) -> None:
+    """Give running session tasks time to finish, then cancel whatever is left."""
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(set(tasks), timeout=TASK_DRAIN_TIMEOUT_SECONDS)
+    if pending:
+        logger.warning(f"Cancelling {len(pending)} unfinished task(s) on shutdown")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Build the shared clients and, unless one was injected, the Gemini-backed service.
+
+    Only what this lifespan creates is closed on shutdown, and the app state it
+    replaced is restored, so the lifespan can run again on the same app.
+    """
+    previous_task_store: TaskStore = app.state.task_store
+    previous_task_semaphore: asyncio.Semaphore = app.state.task_semaphore
+    queue: asyncio.Queue[tuple[str, dict]] = app.state.webhook_queue
+    webhook_client: AsyncClient | None = None
+    client: GeminiClient | None = None
+    service: ImageEditingService | None = None
+    task_store: TaskStore | None = None
+    sweeper: asyncio.Task[None] | None = None
+    workers: list[asyncio.Task[None]] = []
+
+    try:
+        webhook_client = _create_webhook_client()
+        app.state.webhook_client = webhook_client
+
+        webhook_workers = DEFAULT_WEBHOOK_WORKERS
+        webhook_batch_window = 0.0
+        if app.state.service is None:
+            config = AppConfig.from_env()
+            webhook_workers = config.webhook_workers
+            webhook_batch_window = config.webhook_batch_window
+            client = GeminiClient(config.secure_1psid, config.secure_1psidts, proxy=config.proxy)
+            await client.init(
+                timeout=config.timeout,
+                auto_close=config.auto_close,
+                close_delay=config.close_delay,
+                auto_refresh=config.auto_refresh,
+                refresh_interval=config.refresh_interval,
+            )
+            store = SessionStore(max_size=config.session_max_entries, ttl=config.session_ttl)
+            task_store = TaskStore(
+                config.task_db_path,
+                max_size=config.task_max_entries,
+                ttl=config.task_ttl,
+            )
+            service = ImageEditingService(
+                client,
+                store,
+                output_dir=config.image_output_dir,
+                base_url=config.image_base_url,
+                image_concurrency=config.image_concurrency,
+                url_cache_size=config.url_cache_size,
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+            )
+            app.state.task_semaphore = asyncio.Semaphore(config.max_inflight_tasks)
+            app.state.task_store = task_store
+            app.state.gemini_client = client
+            app.state.session_store = store
+            app.state.service = service
+
+            if config.image_base_url is None and not any(getattr(route, "name", None) == "images" for route in app.routes):
+                directory = config.image_output_dir
+                app.mount("/images", StaticFiles(directory=directory, html=False), name="images")
+
+        sweeper = asyncio.create_task(_sweep_expired_tasks(app))
+        app.state.task_sweeper = sweeper
+        delivery_limit = asyncio.Semaphore(WEBHOOK_MAX_CONCURRENT_DELIVERIES)
+        workers = [
+            asyncio.create_task(_webhook_worker(queue, webhook_client, webhook_batch_window, delivery_limit))
+            for _ in range(webhook_workers)
+        ]
+
+        yield
+    finally:
+        if sweeper is not None:
+            sweeper.cancel()
+            app.state.task_sweeper = None
+        # Session tasks write to the task store and enqueue webhooks, so they finish first.
+        await _drain_background_tasks(app.state.background_tasks)
+        if workers:
+            try:
+                await asyncio.wait_for(queue.join(), WEBHOOK_DRAIN_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                logger.warning(f"Dropping {queue.qsize()} undelivered webhook(s) on shutdown")
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        if service is not None:
+            await service.aclose()
+            app.state.service = None
+            app.state.session_store = None
+        if client is not None:
+            await client.close()
+            app.state.gemini_client = None
+        if webhook_client is not None:
+            await webhook_client.aclose()
+            app.state.webhook_client = None
+        if task_store is not None:
+            app.state.task_store = previous_task_store
+            app.state.task_semaphore = previous_task_semaphore
+            task_store.close()
+
+
+def create_app(
+    service: ImageEditingService | None = None,
+    lifespan: Callable[[FastAPI], AbstractAsyncContextManager[None]] | None = lifespan,
+) -> FastAPI:
+    """Build the API app; pass ``lifespan=None`` to skip startup and shutdown entirely."""
+    app = FastAPI(
+        title="Gemini Image Editing API",
+        version="1.0.0",
+        default_response_class=ORJSONResponse,
+        lifespan=lifespan,
+    )
 
     app.state.service = service
     app.state.gemini_client = None
     app.state.session_store = None
     app.state.task_store = TaskStore()
-
-    async def get_service(request: Request) -> ImageEditingService:
-        svc = request.app.state.service
-        if svc is None:
-            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Service not ready")
-        return svc
+    app.state.webhook_client = None
+    app.state.webhook_queue = asyncio.Queue()
+    app.state.task_sweeper = None
+    app.state.task_semaphore = asyncio.Semaphore(DEFAULT_MAX_INFLIGHT_TASKS)
+    app.state.background_tasks = set()
 
     @app.post("/sessions", response_model=ConversationResponse, status_code=status.HTTP_201_CREATED)
     async def start_session(
@@ -216,17 +463,20 @@ def create_app(service: ImageEditingService | None = None) -> FastAPI:
         logger.info(
             f"[POST /sessions] Request received | "
             f"prompt={payload.prompt[:100]!r} | "
-            f"image_urls={[str(u) for u in payload.image_urls]} | "
+            f"image_urls={payload.image_urls} | "
             f"model={payload.model} | gem={payload.gem}"
         )
         t0 = time.monotonic()
         try:
             result = await service.start_session(
                 payload.prompt,
-                image_urls=[str(url) for url in payload.image_urls],
+                image_urls=payload.image_urls,
                 model=payload.model,
                 gem=payload.gem,
+                include_image_data=payload.include_image_data,
             )
+            if isinstance(result, Response):
+                return result
             elapsed = time.monotonic() - t0
             _log_response("POST /sessions", result, elapsed)
             return result
@@ -253,15 +503,18 @@ def create_app(service: ImageEditingService | None = None) -> FastAPI:
         logger.info(
             f"[POST /sessions/{session_id}/messages] Request received | "
             f"prompt={payload.prompt[:100]!r} | "
-            f"image_urls={[str(u) for u in payload.image_urls]}"
+            f"image_urls={payload.image_urls}"
         )
         t0 = time.monotonic()
         try:
             result = await service.continue_session(
                 session_id,
                 prompt=payload.prompt,
-                image_urls=[str(url) for url in payload.image_urls],
+                image_urls=payload.image_urls,
+                include_image_data=payload.include_image_data,
             )
+            if isinstance(result, Response):
+                return result
             elapsed = time.monotonic() - t0
             _log_response(f"POST /sessions/{session_id}/messages", result, elapsed)
             return result
@@ -292,7 +545,7 @@ def create_app(service: ImageEditingService | None = None) -> FastAPI:
         logger.info(
             f"[POST /sessions/async] Request received | "
             f"prompt={payload.prompt[:100]!r} | "
-            f"image_urls={[str(u) for u in payload.image_urls]} | "
+            f"image_urls={payload.image_urls} | "
             f"model={payload.model} | gem={payload.gem} | "
             f"webhook_url={payload.webhook_url}"
         )
@@ -303,24 +556,31 @@ def create_app(service: ImageEditingService | None = None) -> FastAPI:
             status="pending",
             request={
                 "prompt": payload.prompt,
-                "image_urls": [str(url) for url in payload.image_urls],
+                "image_urls": payload.image_urls,
                 "model": payload.model,
                 "gem": payload.gem,
+                "include_image_data": payload.include_image_data,
             },
             webhook_url=str(payload.webhook_url),
         )
         await task_store.create(task_id, task_data)
         
-        # Use asyncio.create_task instead of BackgroundTasks for proper async execution
-        asyncio.create_task(
+        # Use asyncio.create_task instead of BackgroundTasks for proper async execution;
+        # the lifespan waits on these before closing the stores they write to.
+        background_tasks: set[asyncio.Task[None]] = request.app.state.background_tasks
+        task = asyncio.create_task(
             process_task_and_notify(
                 task_id=task_id,
                 task_store=task_store,
                 service=service,
                 request_data=task_data.request,
                 webhook_url=task_data.webhook_url,
+                webhook_queue=request.app.state.webhook_queue,
+                semaphore=request.app.state.task_semaphore,
             )
         )
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
         
         response = TaskCreatedResponse(
             task_id=task_id,
@@ -377,41 +637,6 @@ def create_app(service: ImageEditingService | None = None) -> FastAPI:
     async def health() -> dict[str, str]:
         return {"status": "ok"}
 
-    @app.on_event("startup")
-    async def on_startup() -> None:
-        nonlocal service
-        if service is not None:
-            return
-
-        config = AppConfig.from_env()
-        client = GeminiClient(config.secure_1psid, config.secure_1psidts, proxy=config.proxy)
-        await client.init(
-            timeout=config.timeout,
-            auto_close=config.auto_close,
-            close_delay=config.close_delay,
-            auto_refresh=config.auto_refresh,
-            refresh_interval=config.refresh_interval,
-        )
-        store = SessionStore()
-        app.state.gemini_client = client
-        app.state.session_store = store
-        app.state.service = ImageEditingService(
-            client,
-            store,
-            output_dir=config.image_output_dir,
-            base_url=config.image_base_url,
-        )
-
-        if config.image_base_url is None:
-            directory = config.image_output_dir
-            app.mount("/images", StaticFiles(directory=directory, html=False), name="images")
-
-    @app.on_event("shutdown")
-    async def on_shutdown() -> None:
-        client: GeminiClient | None = app.state.gemini_client
-        if client is not None:
-            await client.close()
-
     @app.exception_handler(ValueError)
     async def value_error_handler(_: Request, exc: ValueError) -> JSONResponse:
         return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"detail": str(exc)})
@@ -422,4 +647,4 @@ def create_app(service: ImageEditingService | None = None) -> FastAPI:
 app = create_app()
 
 
-__all__ = ["create_app", "app"]
+__all__ = ["create_app", "get_service", "app"]
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import os
 from dataclasses import dataclass
+from pathlib import Path
 
 
 def _parse_bool(value: str | None, default: bool) -> bool:
@@ -19,18 +20,47 @@ def _parse_float(value: str | None, default: float) -> float:
         raise ValueError(f"Invalid float value: {value}") from exc
 
 
+def _parse_int(value: str | None, default: int) -> int:
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError as exc:  # noqa: B904
+        raise ValueError(f"Invalid integer value: {value}") from exc
+
+
+def _parse_positive_int(name: str, value: str | None, default: int) -> int:
+    # Used for pool sizes and semaphores, where 0 would hang work instead of failing.
+    parsed = _parse_int(value, default)
+    if parsed < 1:
+        raise ValueError(f"{name} must be at least 1, got {parsed}")
+    return parsed
+
+
 @dataclass(slots=True)
 class AppConfig:
     secure_1psid: str
     secure_1psidts: str | None
     proxy: str | None
-    image_output_dir: str
+    image_output_dir: Path
     image_base_url: str | None
     timeout: float
     auto_close: bool
     close_delay: float
     auto_refresh: bool
     refresh_interval: float
+    image_concurrency: int
+    url_cache_size: int
+    max_connections: int
+    max_keepalive_connections: int
+    session_max_entries: int
+    session_ttl: float
+    task_db_path: str
+    task_max_entries: int
+    task_ttl: float
+    max_inflight_tasks: int
+    webhook_workers: int
+    webhook_batch_window: float
 
     @classmethod
     def from_env(cls) -> "AppConfig":
@@ -41,13 +71,26 @@ class AppConfig:
 
         secure_ts = env.get("SECURE_1PSIDTS") or None
         proxy = env.get("GEMINI_PROXY") or None
-        output_dir = env.get("GEMINI_IMAGE_OUTPUT_DIR", "/data/outputs")
+        output_dir = Path(env.get("GEMINI_IMAGE_OUTPUT_DIR", "/data/outputs")).resolve()
+        output_dir.mkdir(parents=True, exist_ok=True)
         base_url = env.get("GEMINI_IMAGE_BASE_URL")
         timeout = _parse_float(env.get("GEMINI_TIMEOUT"), 300)
         auto_close = _parse_bool(env.get("GEMINI_AUTO_CLOSE"), False)
         close_delay = _parse_float(env.get("GEMINI_CLOSE_DELAY"), 300)
         auto_refresh = _parse_bool(env.get("GEMINI_AUTO_REFRESH"), True)
         refresh_interval = _parse_float(env.get("GEMINI_REFRESH_INTERVAL"), 540)
+        image_concurrency = _parse_positive_int("GEMINI_IMAGE_CONCURRENCY", env.get("GEMINI_IMAGE_CONCURRENCY"), 8)
+        url_cache_size = _parse_int(env.get("GEMINI_URL_CACHE_SIZE"), 512)
+        max_connections = _parse_int(env.get("GEMINI_MAX_CONN"), 200)
+        max_keepalive_connections = _parse_int(env.get("GEMINI_MAX_KEEPALIVE"), 64)
+        session_max_entries = _parse_int(env.get("GEMINI_SESSION_MAX"), 1000)
+        session_ttl = _parse_float(env.get("GEMINI_SESSION_TTL"), 3600)
+        task_db_path = env.get("GEMINI_TASK_DB") or ":memory:"
+        task_max_entries = _parse_int(env.get("GEMINI_TASK_MAX"), 10000)
+        task_ttl = _parse_float(env.get("GEMINI_TASK_TTL"), 86400)
+        max_inflight_tasks = _parse_positive_int("GEMINI_MAX_INFLIGHT", env.get("GEMINI_MAX_INFLIGHT"), 16)
+        webhook_workers = _parse_positive_int("GEMINI_WEBHOOK_WORKERS", env.get("GEMINI_WEBHOOK_WORKERS"), 4)
+        webhook_batch_window = _parse_float(env.get("GEMINI_WEBHOOK_BATCH_WINDOW"), 0)
 
         return cls(
             secure_1psid=secure,
@@ -60,6 +103,18 @@ class AppConfig:
             close_delay=close_delay,
             auto_refresh=auto_refresh,
             refresh_interval=refresh_interval,
+            image_concurrency=image_concurrency,
+            url_cache_size=url_cache_size,
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            session_max_entries=session_max_entries,
+            session_ttl=session_ttl,
+            task_db_path=task_db_path,
+            task_max_entries=task_max_entries,
+            task_ttl=task_ttl,
+            max_inflight_tasks=max_inflight_tasks,
+            webhook_workers=webhook_workers,
+            webhook_batch_window=webhook_batch_window,
         )
 
 
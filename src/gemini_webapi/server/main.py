@@ -1,15 +1,25 @@
 from __future__ import annotations
 
 import os
+from importlib.util import find_spec
 
 import uvicorn
 
 
+def _has_module(name: str) -> bool:
+    return find_spec(name) is not None
+
+
 def main() -> None:
+    # uvloop and httptools ship with uvicorn[standard] but are unavailable on some
+    # platforms (e.g. uvloop on Windows), so fall back to the pure-Python stack.
     uvicorn.run(
         "gemini_webapi.server.app:app",
         host=os.getenv("HOST", "0.0.0.0"),
         port=int(os.getenv("PORT", "8000")),
+        loop="uvloop" if _has_module("uvloop") else "asyncio",
+        http="httptools" if _has_module("httptools") else "h11",
+        workers=int(os.getenv("WORKERS", "1")),
     )
 
 
@@ -1,27 +1,37 @@
 from __future__ import annotations
 
-from typing import Optional
+from typing import Annotated, Optional
 
-from pydantic import BaseModel, Field, HttpUrl
+from pydantic import BaseModel, BeforeValidator, Field, HttpUrl, WithJsonSchema
+
+
+# Validated as an HTTP URL, then stored as a plain string so handlers can pass it on as-is.
+ImageUrl = Annotated[
+    str,
+    BeforeValidator(lambda value: str(HttpUrl(value))),
+    WithJsonSchema({"type": "string", "format": "uri", "minLength": 1}),
+]
 
 
 class StartSessionRequest(BaseModel):
     prompt: str = Field(..., min_length=1)
-    image_urls: list[HttpUrl] = Field(default_factory=list)
+    image_urls: list[ImageUrl] = Field(default_factory=list)
     model: Optional[str] = None
     gem: Optional[str] = None
+    include_image_data: bool = False
 
 
 class ContinueSessionRequest(BaseModel):
     prompt: str = Field(..., min_length=1)
-    image_urls: list[HttpUrl] = Field(default_factory=list)
+    image_urls: list[ImageUrl] = Field(default_factory=list)
+    include_image_data: bool = False
 
 
 class ImagePayload(BaseModel):
     title: str
     alt: str
     mime_type: str
-    data: str
+    data: str = ""  # Base64 content, only filled when include_image_data is requested
     path: str
     url: str | None = None
 
@@ -37,9 +47,10 @@ class ConversationResponse(BaseModel):
 class StartSessionAsyncRequest(BaseModel):
     """Request model for async session creation with webhook callback."""
     prompt: str = Field(..., min_length=1)
-    image_urls: list[HttpUrl] = Field(default_factory=list)
+    image_urls: list[ImageUrl] = Field(default_factory=list)
     model: Optional[str] = None
     gem: Optional[str] = None
+    include_image_data: bool = False
     webhook_url: HttpUrl = Field(..., description="URL to call when processing completes")
 
 
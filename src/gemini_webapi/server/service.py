@@ -2,17 +2,27 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import functools
+import itertools
+import hashlib
 import mimetypes
+import os
 import secrets
+import shutil
+import sqlite3
+import time
+from collections import OrderedDict
 from collections.abc import AsyncIterator, Sequence
 from contextlib import asynccontextmanager
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timedelta
+from http.cookiejar import CookieJar, DefaultCookiePolicy
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Any
+from typing import Any, BinaryIO
 
-from httpx import AsyncClient, HTTPError, HTTPStatusError
+import orjson
+from httpx import AsyncClient, HTTPError, HTTPStatusError, Limits, Response, TooManyRedirects
 from loguru import logger
 
 from ..client import GeminiClient, ChatSession
@@ -31,7 +41,7 @@ class InvalidModelError(ValueError):
 
 @dataclass
 class SessionData:
-    metadata: list[str | None]
+    metadata: tuple[str | None, ...]
     model: str
     gem: str | None
     created_at: datetime = field(default_factory=datetime.utcnow)
@@ -39,34 +49,58 @@ class SessionData:
 
 
 class SessionStore:
-    def __init__(self) -> None:
-        self._sessions: dict[str, SessionData] = {}
+    """In-memory LRU store for chat sessions.
+
+    Metadata is kept as an immutable tuple and replaced wholesale on update, so
+    reads can hand out the stored entry without copying. The store holds at most
+    ``max_size`` sessions and forgets sessions that have not been updated for
+    ``ttl`` seconds. Single-key reads and updates never await, so they are atomic
+    on the event loop; the lock only guards insertion together with eviction.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 3600) -> None:
+        self._sessions: OrderedDict[str, SessionData] = OrderedDict()
         self._lock = asyncio.Lock()
+        self._max_size = max_size
+        self._ttl = timedelta(seconds=ttl)
+
+    def _is_expired(self, data: SessionData, now: datetime) -> bool:
+        return now - data.updated_at > self._ttl
+
+    def _evict(self) -> None:
+        now = datetime.utcnow()
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self._max_size and not self._is_expired(oldest, now):
+                break
+            self._sessions.popitem(last=False)
 
     async def create(self, session_id: str, data: SessionData) -> None:
+        data.metadata = tuple(data.metadata)
         async with self._lock:
             self._sessions[session_id] = data
+            self._sessions.move_to_end(session_id)
+            self._evict()
 
     async def get(self, session_id: str) -> SessionData:
-        async with self._lock:
-            if session_id not in self._sessions:
-                raise SessionNotFoundError(session_id)
+        try:
             data = self._sessions[session_id]
-            return SessionData(
-                metadata=list(data.metadata),
-                model=data.model,
-                gem=data.gem,
-                created_at=data.created_at,
-                updated_at=data.updated_at,
-            )
+        except KeyError:
+            raise SessionNotFoundError(session_id) from None
+        if self._is_expired(data, datetime.utcnow()):
+            self._sessions.pop(session_id, None)
+            raise SessionNotFoundError(session_id)
+        self._sessions.move_to_end(session_id)
+        return data
 
     async def update_metadata(self, session_id: str, metadata: Sequence[str | None]) -> None:
-        async with self._lock:
-            if session_id not in self._sessions:
-                raise SessionNotFoundError(session_id)
+        try:
             stored = self._sessions[session_id]
-            stored.metadata = list(metadata)
-            stored.updated_at = datetime.utcnow()
+        except KeyError:
+            raise SessionNotFoundError(session_id) from None
+        stored.metadata = tuple(metadata)
+        stored.updated_at = datetime.utcnow()
+        self._sessions.move_to_end(session_id)
 
 
 class TaskNotFoundError(KeyError):
@@ -86,87 +120,365 @@ class TaskData:
 
 
 class TaskStore:
-    """In-memory store for tracking async tasks."""
-
-    def __init__(self) -> None:
-        self._tasks: dict[str, TaskData] = {}
+    """SQLite-backed store for tracking async tasks.
+
+    With a file path the tasks survive restarts and can be shared by several
+    worker processes; the default ``":memory:"`` database is private to the
+    process. Queries run in a worker thread and are serialized on a single
+    connection. ``sweep`` only touches finished (completed or failed) tasks: it
+    drops those not updated for ``ttl`` seconds and keeps at most ``max_size``
+    of them, most recently updated first. Pending and processing tasks are
+    never removed.
+    """
+
+    _SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            request TEXT NOT NULL,
+            webhook_url TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_tasks_updated_at ON tasks (updated_at)",
+    )
+
+    def __init__(self, path: str = ":memory:", max_size: int = 10000, ttl: float = 86400) -> None:
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        for statement in self._SCHEMA:
+            self._conn.execute(statement)
         self._lock = asyncio.Lock()
+        self._max_size = max_size
+        self._ttl = timedelta(seconds=ttl)
 
-    async def create(self, task_id: str, data: TaskData) -> None:
+    def _fetch_all(self, sql: str, params: Sequence[Any]) -> list[tuple]:
+        return self._conn.execute(sql, params).fetchall()
+
+    def _row_count(self, sql: str, params: Sequence[Any]) -> int:
+        return self._conn.execute(sql, params).rowcount
+
+    # Execution and fetching both happen in the worker thread while the lock is held,
+    # so no cursor on the shared connection is ever touched from the event loop.
+    async def _query(self, sql: str, params: Sequence[Any] = ()) -> list[tuple]:
         async with self._lock:
-            self._tasks[task_id] = data
+            return await asyncio.to_thread(self._fetch_all, sql, params)
 
-    async def get(self, task_id: str) -> TaskData:
+    async def _execute(self, sql: str, params: Sequence[Any] = ()) -> int:
         async with self._lock:
-            if task_id not in self._tasks:
-                raise TaskNotFoundError(task_id)
-            return self._tasks[task_id]
+            return await asyncio.to_thread(self._row_count, sql, params)
+
+    async def create(self, task_id: str, data: TaskData) -> None:
+        await self._execute(
+            "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                task_id,
+                data.status,
+                orjson.dumps(data.request).decode(),
+                data.webhook_url,
+                data.result.model_dump_json() if data.result is not None else None,
+                data.error,
+                data.created_at.isoformat(),
+                data.updated_at.isoformat(),
+            ),
+        )
+
+    async def get(self, task_id: str) -> TaskData:
+        rows = await self._query(
+            "SELECT status, request, webhook_url, result, error, created_at, updated_at "
+            "FROM tasks WHERE task_id = ?",
+            (task_id,),
+        )
+        if not rows:
+            raise TaskNotFoundError(task_id)
+        status, request, webhook_url, result, error, created_at, updated_at = rows[0]
+        return TaskData(
+            status=status,
+            request=orjson.loads(request),
+            webhook_url=webhook_url,
+            result=ConversationResponse.model_validate_json(result) if result is not None else None,
+            error=error,
+            created_at=datetime.fromisoformat(created_at),
+            updated_at=datetime.fromisoformat(updated_at),
+        )
 
     async def update_status(
         self,
         task_id: str,
         status: str,
-        result: Any = None,
+        result: ConversationResponse | None = None,
         error: str | None = None,
     ) -> None:
-        async with self._lock:
-            if task_id not in self._tasks:
-                raise TaskNotFoundError(task_id)
-            task = self._tasks[task_id]
-            task.status = status
-            task.result = result
-            task.error = error
-            task.updated_at = datetime.utcnow()
-
-
-async def _fetch_bytes(url: str, *, cookies: dict[str, str] | None, proxy: str | None) -> tuple[bytes, str]:
-    logger.debug(f"[_fetch_bytes] Fetching url={url}")
-    async with AsyncClient(http2=True, follow_redirects=True, cookies=cookies, proxy=proxy) as client:
-        response = await client.get(url)
+        updated = await self._execute(
+            "UPDATE tasks SET status = ?, result = ?, error = ?, updated_at = ? WHERE task_id = ?",
+            (
+                status,
+                result.model_dump_json() if result is not None else None,
+                error,
+                datetime.utcnow().isoformat(),
+                task_id,
+            ),
+        )
+        if updated == 0:
+            raise TaskNotFoundError(task_id)
+
+    async def sweep(self) -> int:
+        """Remove expired finished tasks and trim them to ``max_size``. Returns the number removed."""
+        cutoff = (datetime.utcnow() - self._ttl).isoformat()
+        expired = await self._execute(
+            "DELETE FROM tasks WHERE status IN ('completed', 'failed') AND updated_at < ?",
+            (cutoff,),
+        )
+        overflow = await self._execute(
+            "DELETE FROM tasks WHERE task_id IN "
+            "(SELECT task_id FROM tasks WHERE status IN ('completed', 'failed') "
+            "ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self._max_size,),
+        )
+        return expired + overflow
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Output filenames combine a timestamp, a per-process tag and a counter, which keeps
+# them unique across workers without touching the system RNG for every image.
+_PROCESS_TAG = secrets.token_hex(4)
+_FILE_COUNTER = itertools.count()
+
+
+@functools.lru_cache(maxsize=64)
+def _ext_for(mime: str) -> str:
+    return mimetypes.guess_extension(mime) or ".bin"
+
+
+class _Base64Encoder:
+    """Incrementally base64-encode a byte stream chunk by chunk."""
+
+    def __init__(self) -> None:
+        self._encoded = bytearray()
+        self._pending = b""
+
+    def update(self, chunk: bytes) -> None:
+        data = self._pending + chunk
+        cut = len(data) - len(data) % 3
+        self._encoded += base64.b64encode(data[:cut])
+        self._pending = data[cut:]
+
+    def finish(self) -> str:
+        self._encoded += base64.b64encode(self._pending)
+        self._pending = b""
+        return self._encoded.decode("ascii")
+
+
+def _discarding_cookie_jar() -> CookieJar:
+    """Cookie jar that refuses every ``Set-Cookie``, so the shared download client stays stateless."""
+    return CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+
+
+@asynccontextmanager
+async def _open_stream(
+    url: str,
+    *,
+    client: AsyncClient,
+    cookies: dict[str, str] | None = None,
+) -> AsyncIterator[Response]:
+    logger.debug(f"[_open_stream] Fetching url={url}")
+    # Cookies ride on this request only; the client's jar (see _discarding_cookie_jar)
+    # also drops whatever the response sets, so nothing carries over to other downloads.
+    request = client.build_request("GET", url, cookies=cookies)
+    if not cookies:
+        response = await client.send(request, stream=True)
+    else:
+        # httpx rebuilds redirect cookies from the (empty) client jar, so follow the
+        # hops here and put the per-request cookies back on each one.
+        response = await client.send(request, stream=True, follow_redirects=False)
+        hops = 0
+        while response.next_request is not None:
+            next_request = response.next_request
+            await response.aclose()
+            hops += 1
+            if hops > client.max_redirects:
+                raise TooManyRedirects("Exceeded maximum allowed redirects.", request=next_request)
+            request = client.build_request(next_request.method, next_request.url, cookies=cookies)
+            response = await client.send(request, stream=True, follow_redirects=False)
+    try:
+        if response.is_error:
+            # Error bodies are small; read them so callers can log the details.
+            await response.aread()
         response.raise_for_status()
-        mime = response.headers.get("content-type", "application/octet-stream")
-        logger.debug(f"[_fetch_bytes] Success url={url} | status={response.status_code} | mime={mime} | size={len(response.content)} bytes")
-        return response.content, mime
+        yield response
+    finally:
+        await response.aclose()
+
+
+def _write_chunk(fh: BinaryIO, chunk: bytes, encoder: _Base64Encoder | None) -> None:
+    fh.write(chunk)
+    if encoder is not None:
+        encoder.update(chunk)
+
+
+async def _write_stream(
+    response: Response,
+    target: Path,
+    encoder: _Base64Encoder | None = None,
+) -> int:
+    # File I/O and base64 encoding run in worker threads to keep the event loop responsive.
+    size = 0
+    fh = await asyncio.to_thread(target.open, "wb")
+    try:
+        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+            await asyncio.to_thread(_write_chunk, fh, chunk, encoder)
+            size += len(chunk)
+    finally:
+        await asyncio.to_thread(fh.close)
+    return size
+
+
+class _UrlCache:
+    """Bounded LRU of downloaded input images, keyed by source URL.
+
+    Files live in a private temporary directory and are hard-linked (or copied,
+    across filesystems) into each request's working directory, so evicting an
+    entry never affects a request that is still using it. Content is assumed to
+    be stable for a given URL.
+    """
+
+    def __init__(self, max_entries: int = 512) -> None:
+        self._dir = TemporaryDirectory(prefix="gemini-url-cache-")
+        self._entries: OrderedDict[str, tuple[Path, str]] = OrderedDict()
+        self._max_entries = max_entries
+
+    def get(self, url: str) -> tuple[Path, str] | None:
+        """Return the cached ``(path, mime_type)`` for ``url``, if any."""
+        entry = self._entries.get(url)
+        if entry is not None:
+            self._entries.move_to_end(url)
+        return entry
+
+    def discard(self, url: str) -> None:
+        """Forget ``url``, e.g. after its file went missing from under the cache."""
+        self._entries.pop(url, None)
+
+    def staging_path(self, url: str) -> Path:
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        return Path(self._dir.name) / f"{digest}.{next(_FILE_COUNTER)}.part"
+
+    def put(self, url: str, staged: Path, mime: str) -> None:
+        path = staged.with_name(staged.name.split(".", 1)[0])
+        os.replace(staged, path)
+        self._entries[url] = (path, mime)
+        self._entries.move_to_end(url)
+        while len(self._entries) > self._max_entries:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            evicted.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        self._entries.clear()
+        self._dir.cleanup()
+
+
+def _encode_file(path: Path) -> str:
+    return base64.b64encode(path.read_bytes()).decode("ascii")
+
+
+def _link_or_copy(source: Path, target: Path) -> None:
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
 
 
 @asynccontextmanager
-async def _files_from_urls(urls: Sequence[str], *, proxy: str | None) -> AsyncIterator[list[str]]:
+async def _files_from_urls(
+    urls: Sequence[str],
+    *,
+    client: AsyncClient,
+    semaphore: asyncio.Semaphore,
+    cache: _UrlCache,
+) -> AsyncIterator[list[str]]:
     if not urls:
         yield []
         return
 
     with TemporaryDirectory() as tmp_dir:
         dest = Path(tmp_dir)
-        async with AsyncClient(follow_redirects=True, proxy=proxy) as client:
-            async def _download(url: str) -> str:
-                logger.info(f"[_files_from_urls] Downloading input image: {url}")
-                response = await client.get(url)
-                response.raise_for_status()
-                logger.info(f"[_files_from_urls] Downloaded: {url} | status={response.status_code} | size={len(response.content)} bytes")
-                filename = Path(url.split("?")[0]).name or "image"
-                target = dest / filename
-                suffix = 0
-                while target.exists():
-                    suffix += 1
-                    target = dest / f"{Path(filename).stem}_{suffix}{Path(filename).suffix or '.bin'}"
-                target.write_bytes(response.content)
-                return str(target)
 
+        async def _fetch(url: str) -> tuple[Path, str]:
+            async with semaphore:
+                logger.info(f"[_files_from_urls] Downloading input image: {url}")
+                staged = cache.staging_path(url)
+                try:
+                    async with _open_stream(url, client=client) as response:
+                        mime = response.headers.get("content-type", "application/octet-stream")
+                        size = await _write_stream(response, staged)
+                except BaseException:
+                    staged.unlink(missing_ok=True)
+                    raise
+                logger.info(f"[_files_from_urls] Downloaded: {url} | status={response.status_code} | size={size} bytes")
+                return staged, mime
+
+        reserved: set[Path] = set()
+
+        def _reserve_target(url: str) -> Path:
+            filename = Path(url.split("?")[0]).name or "image"
+            target = dest / filename
+            suffix = 0
+            while target in reserved or target.exists():
+                suffix += 1
+                target = dest / f"{Path(filename).stem}_{suffix}{Path(filename).suffix or '.bin'}"
+            reserved.add(target)
+            return target
+
+        async def _download(url: str) -> str:
+            target = _reserve_target(url)
+            # Linking runs in a thread (it is a full copy across filesystems), so a cached
+            # file can disappear meanwhile (eviction, a /tmp reaper); then drop and refetch it.
+            cached = cache.get(url)
+            if cached is not None:
+                logger.info(f"[_files_from_urls] Reusing cached input image: {url}")
+                try:
+                    await asyncio.to_thread(_link_or_copy, cached[0], target)
+                    return str(target)
+                except FileNotFoundError:
+                    if cache.get(url) == cached:
+                        cache.discard(url)
+            staged, mime = await _fetch(url)
             try:
-                files = await asyncio.gather(*(_download(url) for url in urls))
-            except HTTPStatusError as exc:
-                logger.error(
-                    f"[_files_from_urls] Failed to download input image | "
-                    f"status={exc.response.status_code} | url={exc.request.url} | "
-                    f"body={exc.response.text[:500]}"
-                )
-                raise
-            except HTTPError as exc:
-                logger.error(
-                    f"[_files_from_urls] Failed to download input image | "
-                    f"{type(exc).__name__}: {exc}"
-                )
+                await asyncio.to_thread(_link_or_copy, staged, target)
+            except BaseException:
+                staged.unlink(missing_ok=True)
                 raise
+            cache.put(url, staged, mime)
+            return str(target)
+
+        try:
+            # Each distinct URL is fetched once even if the request repeats it.
+            unique_urls = list(dict.fromkeys(urls))
+            downloaded = dict(zip(unique_urls, await asyncio.gather(*(_download(url) for url in unique_urls))))
+            files = [downloaded[url] for url in urls]
+        except HTTPStatusError as exc:
+            logger.error(
+                f"[_files_from_urls] Failed to download input image | "
+                f"status={exc.response.status_code} | url={exc.request.url} | "
+                f"body={exc.response.text[:500]}"
+            )
+            raise
+        except HTTPError as exc:
+            logger.error(
+                f"[_files_from_urls] Failed to download input image | "
+                f"{type(exc).__name__}: {exc}"
+            )
+            raise
 
         yield files
 
@@ -174,35 +486,66 @@ async def _files_from_urls(urls: Sequence[str], *, proxy: str | None) -> AsyncIt
 async def _serialize_images(
     images: Sequence[Image],
     *,
-    proxy: str | None,
+    client: AsyncClient,
+    semaphore: asyncio.Semaphore,
+    cache: _UrlCache,
     output_dir: Path,
+    include_data: bool = False,
 ) -> list[ImagePayload]:
     if not images:
         return []
 
-    output_dir.mkdir(parents=True, exist_ok=True)
-
     async def _serialize(image: Image) -> ImagePayload:
         url = image.url
         cookies = getattr(image, "cookies", None)
         if isinstance(image, GeneratedImage) and not url.endswith("=s2048"):
             url = f"{url}=s2048"
 
-        content, mime = await _fetch_bytes(url, cookies=cookies, proxy=proxy)
-        extension = mimetypes.guess_extension(mime) or ".bin"
-        filename = (
-            f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}_"
-            f"{secrets.token_hex(4)}{extension}"
-        )
-        file_path = output_dir / filename
-        file_path.write_bytes(content)
-        return ImagePayload(
-            title=image.title,
-            alt=image.alt,
-            mime_type=mime,
-            data=base64.b64encode(content).decode("ascii"),
-            path=str(file_path.resolve()),
-        )
+        cached = cache.get(url)
+        if cached is not None:
+            # Same image was already downloaded as an input; copy it instead of refetching.
+            source, mime = cached
+            file_path = output_dir / f"{time.time_ns()}_{_PROCESS_TAG}_{next(_FILE_COUNTER)}{_ext_for(mime)}"
+            try:
+                await asyncio.to_thread(_link_or_copy, source, file_path)
+            except FileNotFoundError:
+                # Gone from under the cache; forget it and download it below instead.
+                if cache.get(url) == cached:
+                    cache.discard(url)
+            else:
+                logger.debug(f"[_serialize_images] Reused cached url={url} | mime={mime}")
+                return ImagePayload(
+                    title=image.title,
+                    alt=image.alt,
+                    mime_type=mime,
+                    data=await asyncio.to_thread(_encode_file, file_path) if include_data else "",
+                    path=str(file_path),
+                )
+
+        async with semaphore:
+            async with _open_stream(url, client=client, cookies=cookies) as response:
+                mime = response.headers.get("content-type", "application/octet-stream")
+                filename = f"{time.time_ns()}_{_PROCESS_TAG}_{next(_FILE_COUNTER)}{_ext_for(mime)}"
+                file_path = output_dir / filename
+                encoder = _Base64Encoder() if include_data else None
+                # Written under a .part name and moved into place only once complete, so a
+                # failed stream never leaves a truncated image in the served directory.
+                partial = file_path.with_name(f"{filename}.part")
+                try:
+                    size = await _write_stream(response, partial, encoder)
+                    os.replace(partial, file_path)
+                except BaseException:
+                    partial.unlink(missing_ok=True)
+                    raise
+            logger.debug(f"[_serialize_images] Saved url={url} | mime={mime} | size={size} bytes")
+            data = await asyncio.to_thread(encoder.finish) if encoder is not None else ""
+            return ImagePayload(
+                title=image.title,
+                alt=image.alt,
+                mime_type=mime,
+                data=data,
+                path=str(file_path),
+            )
 
     return await asyncio.gather(*(_serialize(image) for image in images))
 
@@ -212,13 +555,37 @@ class ImageEditingService:
         self,
         client: GeminiClient,
         store: SessionStore,
-        output_dir: str,
+        output_dir: str | Path,
         base_url: str | None,
+        image_concurrency: int = 8,
+        url_cache_size: int = 512,
+        max_connections: int = 200,
+        max_keepalive_connections: int = 64,
     ) -> None:
         self._client = client
         self._store = store
-        self._output_dir = Path(output_dir)
+        # Resolved once here; the directory itself is created by AppConfig at startup.
+        self._output_dir = Path(output_dir).resolve()
         self._base_url = base_url.rstrip("/") if base_url else None
+        self._http = AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            proxy=client.proxy,
+            cookies=_discarding_cookie_jar(),
+            limits=Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=30.0,
+            ),
+        )
+        # Caps simultaneous image transfers (and buffered bodies) across all requests.
+        self._download_sem = asyncio.Semaphore(image_concurrency)
+        self._url_cache = _UrlCache(url_cache_size)
+
+    async def aclose(self) -> None:
+        """Close the pooled HTTP client and drop cached input images."""
+        await self._http.aclose()
+        self._url_cache.close()
 
     async def start_session(
         self,
@@ -227,15 +594,18 @@ class ImageEditingService:
         image_urls: Sequence[str],
         model: str | None = None,
         gem: str | None = None,
+        include_image_data: bool = False,
     ) -> ConversationResponse:
         chat = self._client.start_chat(model=self._resolve_model(model), gem=gem)
-        output = await self._send(chat, prompt, image_urls)
+        output = await self._send(
+            chat, prompt, image_urls, include_image_data=include_image_data
+        )
 
         session_id = output.session_id
         await self._store.create(
             session_id,
             SessionData(
-                metadata=list(chat.metadata),
+                metadata=tuple(chat.metadata),
                 model=self._model_name(chat.model),
                 gem=self._gem_identifier(chat.gem),
             ),
@@ -248,6 +618,7 @@ class ImageEditingService:
         *,
         prompt: str,
         image_urls: Sequence[str],
+        include_image_data: bool = False,
     ) -> dict[str, Any]:
         stored = await self._store.get(session_id)
         chat = self._client.start_chat(
@@ -255,7 +626,13 @@ class ImageEditingService:
             gem=stored.gem,
             metadata=list(stored.metadata),
         )
-        output = await self._send(chat, prompt, image_urls, session_id=session_id)
+        output = await self._send(
+            chat,
+            prompt,
+            image_urls,
+            session_id=session_id,
+            include_image_data=include_image_data,
+        )
         await self._store.update_metadata(session_id, chat.metadata)
         return output
 
@@ -284,12 +661,18 @@ class ImageEditingService:
         image_urls: Sequence[str],
         *,
         session_id: str | None = None,
+        include_image_data: bool = False,
     ) -> dict[str, Any]:
         if not prompt:
             raise ValueError("prompt cannot be empty")
 
         logger.info(f"[_send] Step 1/3: Downloading {len(image_urls)} input image(s)...")
-        async with _files_from_urls(image_urls, proxy=self._client.proxy) as files:
+        async with _files_from_urls(
+            image_urls,
+            client=self._http,
+            semaphore=self._download_sem,
+            cache=self._url_cache,
+        ) as files:
             logger.info(f"[_send] Step 2/3: Sending prompt to Gemini (files={len(files)})...")
             output = await chat.send_message(prompt, files=files or None)
 
@@ -302,28 +685,22 @@ class ImageEditingService:
         logger.info(f"[_send] Step 3/3: Serializing {len(output.images)} image(s)...")
         images = await _serialize_images(
             output.images,
-            proxy=self._client.proxy,
+            client=self._http,
+            semaphore=self._download_sem,
+            cache=self._url_cache,
             output_dir=self._output_dir,
+            include_data=include_image_data,
         )
 
-        if self._base_url:
-            for image in images:
-                absolute_path = Path(image.path)
-                try:
-                    relative = absolute_path.relative_to(self._output_dir)
-                except ValueError:
-                    image.url = f"{self._base_url}/{absolute_path.name}"
-                else:
-                    image.url = f"{self._base_url}/{relative.as_posix()}"
-        else:
-            for image in images:
-                absolute_path = Path(image.path)
-                try:
-                    relative = absolute_path.relative_to(self._output_dir)
-                except ValueError:
-                    image.url = f"/images/{absolute_path.name}"
-                else:
-                    image.url = f"/images/{relative.as_posix()}"
+        prefix = self._base_url or "/images"
+        output_dir = self._output_dir
+        for image in images:
+            absolute_path = Path(image.path)
+            if absolute_path.is_relative_to(output_dir):
+                relative = absolute_path.relative_to(output_dir).as_posix()
+            else:
+                relative = absolute_path.name
+            image.url = f"{prefix}/{relative}"
 
         logger.info(f"[_send] All steps complete | session_id={session_id} | images_serialized={len(images)}")
         return ConversationResponse(
@@ -0,0 +1,71 @@
+import pytest
+from httpx import ASGITransport, AsyncClient
+
+from gemini_webapi.constants import Model
+from gemini_webapi.server.app import create_app, get_service
+from gemini_webapi.server.service import ImageEditingService, SessionStore
+from gemini_webapi.types import ModelOutput
+
+
+class DummyChat:
+    def __init__(self, output: ModelOutput, *, model: Model | None = None, gem: str | None = None, metadata=None):
+        self._output = output
+        self.model = model or Model.UNSPECIFIED
+        self.gem = gem
+        self.metadata = list(metadata) if metadata else [None, None, None]
+
+    async def send_message(self, prompt: str, files=None):  # noqa: ARG002
+        self.metadata = list(self._output.metadata)
+        return self._output
+
+
+class DummyClient:
+    proxy = None
+
+    def __init__(self, outputs: list[ModelOutput]):
+        self._outputs = outputs
+
+    def start_chat(self, **kwargs):
+        if not self._outputs:
+            raise RuntimeError("No more outputs available")
+        output = self._outputs.pop(0)
+        return DummyChat(output, model=kwargs.get("model"), gem=kwargs.get("gem"), metadata=kwargs.get("metadata"))
+
+
+@pytest.fixture(scope="session")
+def app():
+    # Built once for the whole run; tests swap the service through dependency_overrides
+    # and never need the production lifespan's clients, workers or Gemini login.
+    return create_app(lifespan=None)
+
+
+@pytest.fixture
+async def client(app):
+    # ASGITransport calls the app on the test's own loop.
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+
+@pytest.fixture
+def use_service(app):
+    def _use(service):
+        app.dependency_overrides[get_service] = lambda: service
+        return service
+
+    yield _use
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+async def make_service(tmp_path):
+    services: list[ImageEditingService] = []
+
+    def _make(outputs: list[ModelOutput], *, store: SessionStore | None = None, base_url: str | None = "http://localhost/images"):
+        service = ImageEditingService(DummyClient(outputs), store or SessionStore(), output_dir=tmp_path, base_url=base_url)
+        services.append(service)
+        return service
+
+    yield _make
+    # Each service owns a download client and a URL-cache directory.
+    for service in services:
+        await service.aclose()
@@ -1,121 +1,147 @@
-from fastapi.testclient import TestClient
-from httpx import HTTPError
+import asyncio
+import json
 
-from gemini_webapi.server.app import create_app
+import pytest
+from fastapi import Response as FastAPIResponse
+from httpx import ASGITransport, AsyncClient, HTTPError, MockTransport, Response
+
+from gemini_webapi.server.app import _webhook_worker, create_app, process_task_and_notify
 from gemini_webapi.server.models import ConversationResponse, ImagePayload
-from gemini_webapi.server.service import InvalidModelError, SessionNotFoundError
+from gemini_webapi.server.service import InvalidModelError, SessionNotFoundError, TaskData, TaskStore
+
+
+# Shared by every StubService and only ever read, so it is built once, unvalidated.
+_CANONICAL_RESPONSE = ConversationResponse.model_construct(
+    session_id="session-1",
+    text="ok",
+    metadata=["cid", "rid", "rcid"],
+    thoughts=None,
+    images=[
+        ImagePayload.model_construct(
+            title="t",
+            alt="",
+            mime_type="image/png",
+            data="ZGF0YQ==",
+            path="/tmp/image.png",
+            url="http://localhost/images/image.png",
+        )
+    ],
+)
+
+_PRESERIALIZED = _CANONICAL_RESPONSE.model_dump_json().encode()
 
 
 class StubService:
     def __init__(self):
         self.started_payload = None
         self.continued_payload = None
-        self.response = ConversationResponse(
-            session_id="session-1",
-            text="ok",
-            metadata=["cid", "rid", "rcid"],
-            thoughts=None,
-            images=[
-                ImagePayload(
-                    title="t",
-                    alt="",
-                    mime_type="image/png",
-                    data="ZGF0YQ==",
-                    path="/tmp/image.png",
-                    url="http://localhost/images/image.png",
-                )
-            ],
-        )
+        self.response = _CANONICAL_RESPONSE
 
-    async def start_session(self, prompt, *, image_urls, model=None, gem=None):
+    async def start_session(self, prompt, *, image_urls, model=None, gem=None, include_image_data=False):
         self.started_payload = {
             "prompt": prompt,
             "image_urls": image_urls,
             "model": model,
             "gem": gem,
+            "include_image_data": include_image_data,
         }
         return self.response
 
-    async def continue_session(self, session_id, *, prompt, image_urls):
+    async def continue_session(self, session_id, *, prompt, image_urls, include_image_data=False):
         self.continued_payload = {
             "session_id": session_id,
             "prompt": prompt,
             "image_urls": image_urls,
+            "include_image_data": include_image_data,
         }
         return self.response
 
 
-def test_start_session_endpoint_success():
-    service = StubService()
-    app = create_app(service=service)
-    client = TestClient(app)
+class PreserializedService(StubService):
+    """Returns an already-rendered body, skipping FastAPI's response serialization."""
+
+    async def start_session(self, prompt, **kwargs):  # noqa: ARG002
+        return FastAPIResponse(_PRESERIALIZED, status_code=201, media_type="application/json")
+
+
+@pytest.fixture
+def stub_service(use_service):
+    return use_service(StubService())
+
 
+async def test_start_session_endpoint_success(client, stub_service):
     payload = {"prompt": "edit", "image_urls": ["https://example.com/a.png"]}
-    response = client.post("/sessions", json=payload)
+    response = await client.post("/sessions", json=payload)
 
     assert response.status_code == 201
     assert response.json()["text"] == "ok"
-    assert service.started_payload["image_urls"] == ["https://example.com/a.png"]
+    assert stub_service.started_payload["image_urls"] == ["https://example.com/a.png"]
+    assert stub_service.started_payload["include_image_data"] is False
 
 
-def test_start_session_invalid_model():
+async def test_start_session_rejects_invalid_image_url(client, stub_service):
+    response = await client.post("/sessions", json={"prompt": "edit", "image_urls": ["not a url"]})
+
+    assert response.status_code == 422
+    assert stub_service.started_payload is None
+
+
+async def test_start_session_passes_through_prebuilt_response(client, use_service):
+    use_service(PreserializedService())
+
+    response = await client.post("/sessions", json={"prompt": "edit"})
+
+    assert response.status_code == 201
+    assert response.content == _PRESERIALIZED
+
+
+async def test_start_session_invalid_model(client, use_service):
     class FailingService(StubService):
         async def start_session(self, *args, **kwargs):  # noqa: ARG002
             raise InvalidModelError("bad")
 
-    app = create_app(service=FailingService())
-    client = TestClient(app)
+    use_service(FailingService())
 
-    response = client.post("/sessions", json={"prompt": "edit"})
+    response = await client.post("/sessions", json={"prompt": "edit"})
     assert response.status_code == 400
 
 
-def test_start_session_image_error():
+async def test_start_session_image_error(client, use_service):
     class FailingService(StubService):
         async def start_session(self, *args, **kwargs):  # noqa: ARG002
             raise HTTPError("boom")
 
-    app = create_app(service=FailingService())
-    client = TestClient(app)
+    use_service(FailingService())
 
-    response = client.post("/sessions", json={"prompt": "edit"})
+    response = await client.post("/sessions", json={"prompt": "edit"})
     assert response.status_code == 400
 
 
-def test_continue_session_not_found():
+async def test_continue_session_not_found(client, use_service):
     class MissingService(StubService):
         async def continue_session(self, *args, **kwargs):  # noqa: ARG002
             raise SessionNotFoundError("missing")
 
-    app = create_app(service=MissingService())
-    client = TestClient(app)
+    use_service(MissingService())
 
-    response = client.post("/sessions/abc/messages", json={"prompt": "next"})
+    response = await client.post("/sessions/abc/messages", json={"prompt": "next"})
     assert response.status_code == 404
 
 
-def test_continue_session_success():
-    service = StubService()
-    app = create_app(service=service)
-    client = TestClient(app)
-
-    response = client.post("/sessions/xyz/messages", json={"prompt": "next"})
+async def test_continue_session_success(client, stub_service):
+    response = await client.post("/sessions/xyz/messages", json={"prompt": "next"})
     assert response.status_code == 200
-    assert service.continued_payload["session_id"] == "xyz"
+    assert stub_service.continued_payload["session_id"] == "xyz"
 
 
-def test_start_session_async_returns_task_id():
+async def test_start_session_async_returns_task_id(client, stub_service):
     """Test that /sessions/async returns 202 with task_id immediately."""
-    service = StubService()
-    app = create_app(service=service)
-    client = TestClient(app)
-
     payload = {
         "prompt": "edit async",
         "image_urls": ["https://example.com/a.png"],
         "webhook_url": "https://example.com/webhook",
     }
-    response = client.post("/sessions/async", json=payload)
+    response = await client.post("/sessions/async", json=payload)
 
     assert response.status_code == 202
     data = response.json()
@@ -124,47 +150,158 @@ def test_start_session_async_returns_task_id():
     assert "message" in data
 
 
-def test_start_session_async_missing_webhook():
+async def test_start_session_async_missing_webhook(client, stub_service):
     """Test that /sessions/async requires webhook_url."""
-    service = StubService()
-    app = create_app(service=service)
-    client = TestClient(app)
-
     payload = {"prompt": "edit async"}  # Missing webhook_url
-    response = client.post("/sessions/async", json=payload)
+    response = await client.post("/sessions/async", json=payload)
 
     assert response.status_code == 422  # Validation error
 
 
-def test_get_task_status_not_found():
+async def test_get_task_status_not_found(client, stub_service):
     """Test that /tasks/{task_id} returns 404 for unknown task."""
-    service = StubService()
-    app = create_app(service=service)
-    client = TestClient(app)
-
-    response = client.get("/tasks/unknown-task-id")
+    response = await client.get("/tasks/unknown-task-id")
     assert response.status_code == 404
 
 
-def test_get_task_status_after_async_start():
+async def test_get_task_status_after_async_start(client, stub_service):
     """Test that task status is retrievable after async start."""
-    service = StubService()
-    app = create_app(service=service)
-    client = TestClient(app)
-
     # Start async session
     payload = {
         "prompt": "edit async",
         "webhook_url": "https://example.com/webhook",
     }
-    response = client.post("/sessions/async", json=payload)
+    response = await client.post("/sessions/async", json=payload)
     assert response.status_code == 202
     task_id = response.json()["task_id"]
 
     # Check task status
-    status_response = client.get(f"/tasks/{task_id}")
+    status_response = await client.get(f"/tasks/{task_id}")
     assert status_response.status_code == 200
     status_data = status_response.json()
     assert status_data["task_id"] == task_id
     assert status_data["status"] in ["pending", "processing", "completed"]
 
+
+async def test_lifespan_can_run_twice_with_injected_service():
+    app = create_app(service=StubService())
+    for _ in range(2):
+        async with app.router.lifespan_context(app):
+            pass
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.get("/tasks/unknown-task-id")
+    assert response.status_code == 404
+
+
+async def test_inflight_semaphore_caps_processing_tasks():
+    release = asyncio.Event()
+
+    class BlockingService(StubService):
+        async def start_session(self, *args, **kwargs):  # noqa: ARG002
+            await release.wait()
+            return self.response
+
+    task_store = TaskStore()
+    queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(2)
+    task_ids = [f"task-{index}" for index in range(5)]
+    for task_id in task_ids:
+        await task_store.create(task_id, TaskData(status="pending", request={}, webhook_url="https://example.com/hook"))
+
+    service = BlockingService()
+    runs = [
+        asyncio.create_task(
+            process_task_and_notify(
+                task_id=task_id,
+                task_store=task_store,
+                service=service,
+                request_data={"prompt": "edit", "image_urls": []},
+                webhook_url="https://example.com/hook",
+                webhook_queue=queue,
+                semaphore=semaphore,
+            )
+        )
+        for task_id in task_ids
+    ]
+    async def statuses():
+        return [(await task_store.get(task_id)).status for task_id in task_ids]
+
+    for _ in range(100):
+        if (await statuses()).count("processing") >= 2:
+            break
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.05)  # room for a task past the cap to show up if the cap leaked
+
+    current = await statuses()
+    assert current.count("processing") == 2
+    assert current.count("pending") == 3
+
+    release.set()
+    await asyncio.gather(*runs)
+    assert queue.qsize() == 5
+    task_store.close()
+
+
+async def test_task_missing_from_store_still_queues_webhook():
+    task_store = TaskStore()
+    queue = asyncio.Queue()
+
+    await process_task_and_notify(
+        task_id="swept",
+        task_store=task_store,
+        service=StubService(),
+        request_data={"prompt": "edit", "image_urls": []},
+        webhook_url="https://example.com/hook",
+        webhook_queue=queue,
+        semaphore=asyncio.Semaphore(1),
+    )
+    task_store.close()
+
+    webhook_url, payload = queue.get_nowait()
+    assert webhook_url == "https://example.com/hook"
+    assert payload["task_id"] == "swept"
+    assert payload["status"] == "failed"
+
+
+async def test_webhook_worker_batches_payloads_per_url():
+    received = []
+
+    def handler(request):
+        received.append((str(request.url), json.loads(request.content)))
+        return Response(200)
+
+    queue = asyncio.Queue()
+    for index in range(3):
+        queue.put_nowait(("https://example.com/a", {"task_id": str(index)}))
+    queue.put_nowait(("https://example.com/b", {"task_id": "3"}))
+    async with AsyncClient(transport=MockTransport(handler)) as client:
+        worker = asyncio.create_task(_webhook_worker(queue, client, 0.05, asyncio.Semaphore(4)))
+        await queue.join()
+        worker.cancel()
+
+    assert received == [
+        ("https://example.com/a", {"events": [{"task_id": "0"}, {"task_id": "1"}, {"task_id": "2"}]}),
+        ("https://example.com/b", {"events": [{"task_id": "3"}]}),
+    ]
+
+
+async def test_webhook_worker_does_not_wait_on_unresponsive_endpoint():
+    delivered = asyncio.Event()
+
+    async def handler(request):
+        if request.url.host == "dead.example.com":
+            await asyncio.Event().wait()  # never answers, like an endpoint stuck until timeout
+        delivered.set()
+        return Response(200)
+
+    queue = asyncio.Queue()
+    queue.put_nowait(("https://dead.example.com/hook", {"task_id": "0"}))
+    queue.put_nowait(("https://live.example.com/hook", {"task_id": "1"}))
+    async with AsyncClient(transport=MockTransport(handler)) as client:
+        worker = asyncio.create_task(_webhook_worker(queue, client, 0, asyncio.Semaphore(4)))
+        try:
+            await asyncio.wait_for(delivered.wait(), 1)
+        finally:
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
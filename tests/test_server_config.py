@@ -0,0 +1,25 @@
+import pytest
+
+from gemini_webapi.server.config import AppConfig
+
+
+@pytest.fixture
+def base_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("SECURE_1PSID", "cookie")
+    monkeypatch.setenv("GEMINI_IMAGE_OUTPUT_DIR", str(tmp_path))
+
+
+@pytest.mark.parametrize("name", ["GEMINI_IMAGE_CONCURRENCY", "GEMINI_MAX_INFLIGHT", "GEMINI_WEBHOOK_WORKERS"])
+def test_from_env_rejects_non_positive_limits(base_env, monkeypatch, name):
+    monkeypatch.setenv(name, "0")
+
+    with pytest.raises(ValueError, match=name):
+        AppConfig.from_env()
+
+
+def test_from_env_defaults(base_env):
+    config = AppConfig.from_env()
+
+    assert config.image_concurrency == 8
+    assert config.max_inflight_tasks == 16
+    assert config.webhook_workers == 4
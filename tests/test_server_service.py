@@ -1,64 +1,46 @@
 import asyncio
+import base64
+import os
 from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from pathlib import Path
 
 import pytest
+from httpx import AsyncByteStream, AsyncClient, HTTPStatusError, MockTransport, ReadError, Response
 
-from gemini_webapi.constants import Model
 from gemini_webapi.server import service as service_module
 from gemini_webapi.server.models import ConversationResponse, ImagePayload
 from gemini_webapi.server.service import (
-    ImageEditingService,
+    STREAM_CHUNK_SIZE,
     InvalidModelError,
+    SessionData,
     SessionNotFoundError,
     SessionStore,
+    TaskData,
+    TaskNotFoundError,
+    TaskStore,
+    _Base64Encoder,
+    _UrlCache,
+    _files_from_urls,
+    _serialize_images,
 )
-from gemini_webapi.types import Candidate, ModelOutput, GeneratedImage
-
-
-class DummyChat:
-    def __init__(self, output: ModelOutput, *, model: Model | None = None, gem: str | None = None, metadata=None):
-        self._output = output
-        self.model = model or Model.UNSPECIFIED
-        self.gem = gem
-        self.metadata = list(metadata) if metadata else [None, None, None]
-
-    async def send_message(self, prompt: str, files=None):  # noqa: ARG002
-        self.metadata = list(self._output.metadata)
-        return self._output
-
-
-class DummyClient:
-    proxy = None
-
-    def __init__(self, outputs: list[ModelOutput]):
-        self._outputs = outputs
-
-    def start_chat(self, **kwargs):
-        if not self._outputs:
-            raise RuntimeError("No more outputs available")
-        output = self._outputs.pop(0)
-        return DummyChat(output, model=kwargs.get("model"), gem=kwargs.get("gem"), metadata=kwargs.get("metadata"))
+from gemini_webapi.types import Candidate, GeneratedImage, ModelOutput, WebImage
 
 
 @pytest.fixture(autouse=True)
-def patch_helpers(monkeypatch, tmp_path):
+def patch_helpers(monkeypatch):
     @asynccontextmanager
-    async def fake_files(urls, proxy=None):  # noqa: ARG001
+    async def fake_files(urls, client=None, semaphore=None, cache=None):  # noqa: ARG001
         yield ["/tmp/fake.png" for _ in urls]
 
-    async def fake_serialize(images, proxy=None, output_dir=None):  # noqa: ARG001
-        target_dir = Path(output_dir) if output_dir else tmp_path
-        target_dir.mkdir(parents=True, exist_ok=True)
-        path = target_dir / "image.png"
-        path.write_bytes(b"data")
+    async def fake_serialize(images, client=None, semaphore=None, cache=None, output_dir=None, include_data=False):  # noqa: ARG001
         return [
             ImagePayload(
                 title=image.title,
                 alt=image.alt,
                 mime_type="image/png",
                 data="ZGF0YQ==",
-                path=str(path),
+                path=f"/virtual/{image.title}.png",
                 url="http://localhost/images/image.png",
             )
             for image in images
@@ -72,7 +54,7 @@ def make_output(text: str, metadata, with_image: bool = False):
     generated_images = []
     if with_image:
         generated_images = [
-            GeneratedImage(
+            GeneratedImage.model_construct(
                 url="https://example.com/image",
                 title="Generated",
                 alt="",
@@ -81,10 +63,10 @@ def make_output(text: str, metadata, with_image: bool = False):
             )
         ]
 
-    return ModelOutput(
+    return ModelOutput.model_construct(
         metadata=metadata,
         candidates=[
-            Candidate(
+            Candidate.model_construct(
                 rcid="rcid",
                 text=text,
                 web_images=[],
@@ -94,64 +76,294 @@ def make_output(text: str, metadata, with_image: bool = False):
     )
 
 
-def test_start_session_creates_store_entry():
+async def test_start_session_creates_store_entry(make_service):
     output = make_output("Edited image", ["cid1", "rid1", "rcid1"], with_image=True)
-    client = DummyClient([output])
     store = SessionStore()
-    service = ImageEditingService(client, store, output_dir="/tmp", base_url="http://localhost/images")
+    service = make_service([output], store=store)
 
-    response = asyncio.run(service.start_session("prompt", image_urls=["https://example.com/image.png"]))
+    response = await service.start_session("prompt", image_urls=["https://example.com/image.png"])
 
     assert isinstance(response, ConversationResponse)
     assert response.text == "Edited image"
     assert response.images[0].path
     assert response.images[0].url
-    stored = asyncio.run(store.get(response.session_id))
-    assert stored.metadata == ["cid1", "rid1", "rcid1"]
+    stored = await store.get(response.session_id)
+    assert stored.metadata == ("cid1", "rid1", "rcid1")
 
 
-def test_start_session_generates_relative_url(tmp_path):
+async def test_start_session_generates_relative_url(make_service):
     output = make_output("Edited image", ["cid1", "rid1", "rcid1"], with_image=True)
-    client = DummyClient([output])
-    store = SessionStore()
-    service = ImageEditingService(client, store, output_dir=str(tmp_path), base_url=None)
+    service = make_service([output], base_url=None)
 
-    response = asyncio.run(service.start_session("prompt", image_urls=[]))
+    response = await service.start_session("prompt", image_urls=[])
 
     assert response.images[0].url.startswith("/images/")
 
 
-def test_continue_session_updates_metadata():
+async def test_continue_session_updates_metadata(make_service):
     first_output = make_output("First", ["cid1", "rid1", "rcid1"])
     second_output = make_output("Second", ["cid2", "rid2", "rcid2"])
-    client = DummyClient([first_output, second_output])
     store = SessionStore()
-    service = ImageEditingService(client, store, output_dir="/tmp", base_url="http://localhost/images")
+    service = make_service([first_output, second_output], store=store)
 
-    first_response = asyncio.run(service.start_session("prompt", image_urls=[]))
+    first_response = await service.start_session("prompt", image_urls=[])
 
-    second_response = asyncio.run(
-        service.continue_session(first_response.session_id, prompt="next", image_urls=[])
-    )
+    second_response = await service.continue_session(first_response.session_id, prompt="next", image_urls=[])
 
     assert second_response.text == "Second"
-    stored = asyncio.run(store.get(first_response.session_id))
-    assert stored.metadata == ["cid2", "rid2", "rcid2"]
+    stored = await store.get(first_response.session_id)
+    assert stored.metadata == ("cid2", "rid2", "rcid2")
 
 
-def test_continue_session_missing(monkeypatch):
-    client = DummyClient([make_output("text", ["cid", "rid", "rcid"])])
-    store = SessionStore()
-    service = ImageEditingService(client, store, output_dir="/tmp", base_url="http://localhost/images")
+async def test_continue_session_missing(make_service):
+    service = make_service([make_output("text", ["cid", "rid", "rcid"])])
 
     with pytest.raises(SessionNotFoundError):
-        asyncio.run(service.continue_session("missing", prompt="p", image_urls=[]))
+        await service.continue_session("missing", prompt="p", image_urls=[])
 
 
-def test_invalid_model_raises_error():
-    client = DummyClient([make_output("text", ["cid", "rid", "rcid"])])
-    store = SessionStore()
-    service = ImageEditingService(client, store, output_dir="/tmp", base_url="http://localhost/images")
+async def test_invalid_model_raises_error(make_service):
+    service = make_service([make_output("text", ["cid", "rid", "rcid"])])
 
     with pytest.raises(InvalidModelError):
-        asyncio.run(service.start_session("prompt", image_urls=[], model="invalid-model"))
+        await service.start_session("prompt", image_urls=[], model="invalid-model")
+
+
+async def test_session_store_evicts_least_recently_used():
+    store = SessionStore(max_size=2)
+
+    for session_id in ("a", "b"):
+        await store.create(session_id, SessionData(metadata=[], model="m", gem=None))
+    await store.get("a")
+    await store.create("c", SessionData(metadata=[], model="m", gem=None))
+    await store.get("a")
+    await store.get("c")
+    with pytest.raises(SessionNotFoundError):
+        await store.get("b")
+
+
+async def test_task_store_sweep_removes_expired_tasks():
+    store = TaskStore(ttl=60)
+
+    stale = datetime.utcnow() - timedelta(seconds=120)
+    await store.create(
+        "old",
+        TaskData(status="completed", request={}, webhook_url="http://hook", updated_at=stale),
+    )
+    await store.create("new", TaskData(status="pending", request={}, webhook_url="http://hook"))
+    assert await store.sweep() == 1
+    await store.get("new")
+    with pytest.raises(TaskNotFoundError):
+        await store.get("old")
+
+
+async def test_task_store_sweep_keeps_unfinished_tasks():
+    store = TaskStore(max_size=1, ttl=60)
+
+    stale = datetime.utcnow() - timedelta(seconds=120)
+    for task_id in ("pending-1", "pending-2"):
+        await store.create(task_id, TaskData(status="pending", request={}, webhook_url="http://hook", updated_at=stale))
+    older = datetime.utcnow() - timedelta(seconds=10)
+    await store.create("done-1", TaskData(status="completed", request={}, webhook_url="http://hook", updated_at=older))
+    await store.create("done-2", TaskData(status="failed", request={}, webhook_url="http://hook"))
+
+    assert await store.sweep() == 1
+    for task_id in ("pending-1", "pending-2", "done-2"):
+        await store.get(task_id)
+
+
+async def test_download_client_does_not_keep_response_cookies():
+    sent_cookies = []
+
+    def handler(request):
+        sent_cookies.append(request.headers.get("cookie"))
+        return Response(200, headers={"set-cookie": "sid=abc; Path=/"}, content=b"img")
+
+    async with AsyncClient(transport=MockTransport(handler), cookies=service_module._discarding_cookie_jar()) as client:
+        async with service_module._open_stream("https://example.com/a.png", client=client, cookies={"token": "t"}) as response:
+            await response.aread()
+        async with service_module._open_stream("https://example.com/b.png", client=client) as response:
+            await response.aread()
+
+    assert sent_cookies == ["token=t", None]
+    assert not client.cookies
+
+
+# The helpers below are imported before patch_helpers swaps them out on the module,
+# so these tests exercise the real download path against a MockTransport.
+
+
+class ImageServer:
+    def __init__(self, bodies: dict[str, bytes]):
+        self.bodies = bodies
+        self.hits: dict[str, int] = {}
+
+    def __call__(self, request):
+        url = str(request.url)
+        self.hits[url] = self.hits.get(url, 0) + 1
+        if url not in self.bodies:
+            return Response(404, content=b"missing")
+        return Response(200, headers={"content-type": "image/png"}, content=self.bodies[url])
+
+
+@pytest.fixture
+def url_cache():
+    cache = _UrlCache(max_entries=8)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+async def download_args(url_cache):
+    clients = []
+
+    def _args(server: ImageServer, cache: _UrlCache | None = None) -> dict:
+        client = AsyncClient(transport=MockTransport(server))
+        clients.append(client)
+        return {"client": client, "semaphore": asyncio.Semaphore(4), "cache": cache or url_cache}
+
+    yield _args
+    for client in clients:
+        await client.aclose()
+
+
+async def test_files_from_urls_fetches_duplicate_url_once(download_args):
+    url = "https://example.com/a.png"
+    server = ImageServer({url: b"image-a"})
+    args = download_args(server)
+
+    async with _files_from_urls([url, url], **args) as files:
+        assert len(files) == 2
+        assert [Path(path).read_bytes() for path in files] == [b"image-a", b"image-a"]
+
+    assert server.hits == {url: 1}
+
+
+async def test_files_from_urls_reuses_cache_across_requests(download_args):
+    url = "https://example.com/a.png"
+    server = ImageServer({url: b"image-a"})
+    args = download_args(server)
+
+    for _ in range(2):
+        async with _files_from_urls([url], **args) as files:
+            assert Path(files[0]).read_bytes() == b"image-a"
+
+    assert server.hits == {url: 1}
+
+
+async def test_files_from_urls_refetches_missing_cached_file(download_args, url_cache):
+    url = "https://example.com/a.png"
+    server = ImageServer({url: b"image-a"})
+    args = download_args(server)
+
+    async with _files_from_urls([url], **args):
+        pass
+    url_cache.get(url)[0].unlink()
+
+    async def request_again():
+        async with _files_from_urls([url], **args) as files:
+            return Path(files[0]).read_bytes()
+
+    assert await asyncio.wait_for(request_again(), 5) == b"image-a"
+    assert server.hits == {url: 2}
+
+
+async def test_url_cache_eviction_keeps_linked_copies(download_args):
+    first, second = "https://example.com/a.png", "https://example.com/b.png"
+    server = ImageServer({first: b"image-a", second: b"image-b"})
+    cache = _UrlCache(max_entries=1)
+    args = download_args(server, cache)
+    try:
+        async with _files_from_urls([first], **args) as held:
+            cached_path, _ = cache.get(first)
+            async with _files_from_urls([second], **args):
+                pass
+            assert cache.get(first) is None
+            assert not cached_path.exists()
+            assert Path(held[0]).read_bytes() == b"image-a"
+    finally:
+        cache.close()
+
+
+async def test_files_from_urls_error_leaves_no_partial_file(url_cache, download_args):
+    server = ImageServer({})
+    args = download_args(server)
+
+    with pytest.raises(HTTPStatusError):
+        async with _files_from_urls(["https://example.com/missing.png"], **args):
+            pass
+
+    assert os.listdir(url_cache._dir.name) == []
+
+
+def test_base64_encoder_matches_across_chunk_boundaries():
+    data = os.urandom(3 * STREAM_CHUNK_SIZE + 1)
+    encoder = _Base64Encoder()
+    for start in range(0, len(data), STREAM_CHUNK_SIZE):
+        encoder.update(data[start : start + STREAM_CHUNK_SIZE])
+
+    assert encoder.finish() == base64.b64encode(data).decode("ascii")
+
+
+async def test_serialize_images_streams_file_and_data(download_args, tmp_path):
+    url = "https://example.com/out.png"
+    body = os.urandom(2 * STREAM_CHUNK_SIZE + 5)
+    server = ImageServer({url: body})
+    image = WebImage(url=url, title="out")
+
+    payloads = await _serialize_images([image], output_dir=tmp_path, include_data=True, **download_args(server))
+
+    assert Path(payloads[0].path).read_bytes() == body
+    assert payloads[0].data == base64.b64encode(body).decode("ascii")
+
+
+async def test_serialize_images_reuses_cached_input(download_args, tmp_path):
+    url = "https://example.com/a.png"
+    server = ImageServer({url: b"image-a"})
+    args = download_args(server)
+
+    async with _files_from_urls([url], **args):
+        pass
+    payloads = await _serialize_images([WebImage(url=url, title="a")], output_dir=tmp_path, **args)
+
+    assert server.hits == {url: 1}
+    assert Path(payloads[0].path).read_bytes() == b"image-a"
+    assert payloads[0].mime_type == "image/png"
+
+
+async def test_open_stream_keeps_cookies_across_redirects():
+    def handler(request):
+        if request.url.path == "/gg-dl/start":
+            return Response(302, headers={"location": "https://cdn.example.com/image.png"})
+        if "__Secure-1PSID=cookie" not in request.headers.get("cookie", ""):
+            return Response(403)
+        return Response(200, content=b"img")
+
+    transport = MockTransport(handler)
+    async with AsyncClient(transport=transport, follow_redirects=True, cookies=service_module._discarding_cookie_jar()) as client:
+        async with service_module._open_stream(
+            "https://example.com/gg-dl/start", client=client, cookies={"__Secure-1PSID": "cookie"}
+        ) as response:
+            assert await response.aread() == b"img"
+
+
+async def test_serialize_images_removes_partial_output_on_stream_error(url_cache, tmp_path):
+    class BrokenStream(AsyncByteStream):
+        async def __aiter__(self):
+            yield b"x" * STREAM_CHUNK_SIZE
+            raise ReadError("connection reset")
+
+    def handler(request):
+        return Response(200, headers={"content-type": "image/png"}, stream=BrokenStream())
+
+    async with AsyncClient(transport=MockTransport(handler)) as client:
+        with pytest.raises(ReadError):
+            await _serialize_images(
+                [WebImage(url="https://example.com/out.png")],
+                client=client,
+                semaphore=asyncio.Semaphore(1),
+                cache=url_cache,
+                output_dir=tmp_path,
+            )
+
+    assert list(tmp_path.iterdir()) == []